@@ -517,14 +517,10 @@ def main():
 
         if video_encoder is not None:
             try:
+                # the encoder writes the frames that are still queued before closing the output file
                 video_encoder.stop()
-                # Add timeout to join to prevent hanging
-                video_encoder.join(timeout=5)
-                
-                # Force close the output container if still open
-                if hasattr(video_encoder, 'output_container') and video_encoder.output_container:
-                    video_encoder.output_container.close()
-                
+                video_encoder.join()
+
                 if idx > 0:
                     logging.info(f"Saved video to {E_path}")
                     # Print hyperlink to output directory
@@ -1,7 +1,18 @@
 import argparse
 import cv2
 import math
+import numpy as np
 import os.path
+import queue
+import threading
+
+# every frame allocates tensors of the same shapes, so let the caching allocator grow segments in place
+# instead of splitting and re-allocating blocks. expandable segments are not supported on Windows
+if os.name == 'nt':
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'max_split_size_mb:512,garbage_collection_threshold:0.9')
+else:
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:512,garbage_collection_threshold:0.9')
+
 import torch
 import av
 
@@ -9,7 +20,7 @@ from datetime import timedelta
 from fractions import Fraction
 
 from utils import utils_image as util
-from utils.utils_video import VideoDecoder, VideoEncoder
+from utils.utils_video import VideoDecoder, NvVideoDecoder, VideoEncoder
 
 if not torch.cuda.is_available():
     print('CUDA is not available. Exiting...')
@@ -28,6 +39,106 @@ else:
     else:
         default_dtype = torch.float32
 
+class FrameUploader(threading.Thread):
+    """
+    Reads frames on a background thread, uploads them on a dedicated copy stream and queues them as uint HxWxC CUDA tensors.
+    read_frame returns numpy frames, or (CUDA frame, ready event) pairs for frames that are already on the GPU
+    """
+    def __init__(self, read_frame, device, maxsize):
+        super().__init__(daemon=True)
+
+        self.read_frame = read_frame
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+        self.frame_queue = queue.Queue(maxsize)
+        self.running = True
+
+    def run(self):
+        error = None
+        try:
+            with torch.cuda.stream(self.stream):
+                while self.running:
+                    frame = self.read_frame()
+                    if frame is None:
+                        break
+
+                    if isinstance(frame, tuple):
+                        # NVDEC frames are already on the GPU, together with the event recorded after their conversion
+                        frame, ready = frame
+                    else:
+                        # everything else is staged in pinned memory and uploaded asynchronously.
+                        # 16-bit frames are uploaded as int16, uinttensor2tensor4 reads them back as uint16
+                        if frame.dtype == np.uint16:
+                            frame = frame.view(np.int16)
+                        frame = torch.from_numpy(frame).pin_memory().to(self.device, non_blocking=True)
+                        ready = torch.cuda.Event()
+                        ready.record(self.stream)
+
+                    self.frame_queue.put((frame, ready), block=True)
+        except Exception as e:
+            # hand the error to the frame loop instead of leaving it waiting for frames
+            error = e
+        finally:
+            # signal the end of the input
+            self.frame_queue.put((None, error), block=True)
+
+    def get_frame(self):
+        # returns a frame and the event to wait on before using it, or (None, None) once the input is exhausted.
+        # errors raised while reading or uploading are raised here
+        frame, ready = self.frame_queue.get(block=True)
+        if isinstance(ready, Exception):
+            raise ready
+        return frame, ready
+
+    def stop(self):
+        self.running = False
+
+class FrameTimer:
+    """
+    Measures the time between frames with a ring of CUDA events that are only read back once they have completed,
+    so timing never makes the frame loop wait for the GPU. Every record covers batch frames, times are in milliseconds per frame.
+    """
+    def __init__(self, interval=16, batch=1):
+        self.interval = interval
+        self.batch = batch
+        self.events = [torch.cuda.Event(enable_timing=True) for _ in range(2 * interval + 1)]
+        self.recorded = 0
+        self.measured = 0
+        self.total_time = 0
+        self.total_frames = 0
+
+    def record(self):
+        # mark the start of a batch, returns the average frame time of a past interval when one could be measured
+        self.events[self.recorded % len(self.events)].record()
+        self.recorded += 1
+        if self.recorded - 1 - self.measured < 2 * self.interval:
+            return None
+
+        start = self.events[self.measured % len(self.events)]
+        end = self.events[(self.measured + self.interval) % len(self.events)]
+        self.measured += self.interval
+        if not end.query():
+            # the GPU is more than an interval behind, skip these frames rather than waiting
+            return None
+
+        time_taken = start.elapsed_time(end)
+        self.total_time += time_taken
+        self.total_frames += self.interval * self.batch
+        return time_taken / (self.interval * self.batch)
+
+    def finish(self):
+        # wait for the GPU and measure the frames that are still pending
+        if self.recorded > self.measured:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            end.synchronize()
+            self.total_time += self.events[self.measured % len(self.events)].elapsed_time(end)
+            self.total_frames += (self.recorded - self.measured) * self.batch
+            self.measured = self.recorded
+
+    def average(self):
+        return self.total_time / max(self.total_frames, 1)
+
 def main():
     n_channels = 3
 
@@ -47,7 +158,15 @@ def main():
                         help='video framerate (defaults to input video\'s frame rate when processing video)')
     parser.add_argument('--res', type=str, default=None, help='video resolution to scale output to (optional, will auto-calculate if not specified)')
     parser.add_argument('--presize', action='store_true', help='resize video before processing')
+    parser.add_argument('--nvdec', action='store_true', help='decode input video on the GPU with NVDEC (requires PyNvVideoCodec)')
     parser.add_argument('--gui-mode', action='store_true', help='Output progress in a format optimized for GUI parsing')
+    backend = parser.add_mutually_exclusive_group()
+    backend.add_argument('--trt', type=str, default=None, choices=['fp16', 'int8'], help='run the model through a TensorRT engine built for the input resolution')
+    backend.add_argument('--compile', action='store_true', help='compile the model with torch.compile and replay it as a CUDA graph')
+    backend.add_argument('--jit', action='store_true', help='trace and freeze the model with TorchScript for the input resolution')
+    parser.add_argument('--tile', type=int, default=None, help='process frames in overlapping tiles of this size to reduce VRAM usage')
+    parser.add_argument('--batch', type=int, default=1, help='number of consecutive clips to process per forward pass')
+    parser.add_argument('--calib_frames', type=int, default=500, help='number of frames used to calibrate INT8 TensorRT engines')
 
     args = parser.parse_args()
 
@@ -55,6 +174,13 @@ def main():
         parser.print_help()
         raise ValueError('Please specify model_path')
 
+    if args.tile and (args.trt or args.compile or args.jit):
+        parser.error('--tile is not supported with --trt, --compile or --jit')
+    if args.tile is not None and args.tile <= 32:
+        parser.error('--tile must be larger than the 32 pixel tile overlap')
+    if args.batch < 1:
+        parser.error('--batch must be at least 1')
+
     model_path = args.model_path
     model_name = os.path.splitext(os.path.basename(model_path))[0]
     
@@ -91,27 +217,20 @@ def main():
     # ----------------------------------------
     # load model
     # ----------------------------------------
-    torch.cuda.empty_cache()
-
     from models.network_tscunet import TSCUNet as net
     model = net(state=torch.load(model_path))
     model.eval()
     scale = model.scale
     clip_size = model.clip_size
+    batch = args.batch
 
-    for k, v in model.named_parameters():
-        v.requires_grad = False
-    model = model.to(default_device)
-    
-    input_shape = (1, clip_size, 3, 540, 720)
-    dummy_input = torch.randn(input_shape).to(default_device, dtype=default_dtype)
+    for p in model.parameters():
+        p.requires_grad_(False)
 
-    torch.cuda.empty_cache()
-    
-    # warmup
-    with torch.no_grad():
-        with torch.cuda.amp.autocast(dtype=default_dtype):
-            _ = model(dummy_input)
+    # fold the 1/255 input normalization into the first conv, so 8-bit frames only need a cast after upload.
+    # from here on the model expects inputs in the range [0, 255]
+    model.m_head[0].weight.mul_(1/255.)
+    model = model.to(default_device)
 
     print('Model path: {:s}'.format(model_path))
 
@@ -142,13 +261,17 @@ def main():
             input_fps = container.streams.video[0].average_rate
         
         # Use the input video's frame rate for decoding
-        video_decoder = VideoDecoder(L_path, options={'r': str(input_fps)})
+        if args.nvdec:
+            video_decoder = NvVideoDecoder(L_path, options={'r': str(input_fps)})
+        else:
+            video_decoder = VideoDecoder(L_path, options={'r': str(input_fps)})
         video_decoder.start()
     else:
         # For image input, get resolution from first image
         if len(L_paths) > 0:
             first_img = util.imread_uint(L_paths[0], n_channels=n_channels)
             input_height, input_width = first_img.shape[:2]
+            img_count = len(L_paths)
         else:
             print('Error: no input images found.')
             return
@@ -163,15 +286,136 @@ def main():
             # Otherwise, scale up by model's scale factor
             output_width = input_width * scale
             output_height = input_height * scale
-        output_res = f"{output_width}:{output_height}"
     else:
-        output_res = args.res
+        output_width, output_height = map(int, args.res.split(':'))
+
+    if args.presize:
+        input_width, input_height = output_width//scale, output_height//scale
+    # the model output only needs resizing when it doesn't already match the requested resolution
+    resize_output = (input_width * scale, input_height * scale) != (output_width, output_height)
+    input_shape = (batch, clip_size, 3, input_height, input_width)
+
+    if args.trt:
+        from utils.utils_trt import TrtRunner
 
-    input_window = []
+        def load_calib_frames():
+            # calibrate on the first frames of the input itself
+            if video_input:
+                calib_decoder = VideoDecoder(L_path, options={'r': str(input_fps)})
+                calib_decoder.start()
+                calib_frames = []
+                while len(calib_frames) < args.calib_frames:
+                    frame = calib_decoder.get_frame()
+                    if frame is None:
+                        break
+                    calib_frames += [frame]
+                calib_decoder.stop()
+            else:
+                calib_frames = [util.imread_uint(path, n_channels=n_channels) for path in L_paths[:args.calib_frames]]
+            if args.presize:
+                calib_frames = [cv2.resize(frame, (input_width, input_height), interpolation=cv2.INTER_CUBIC) for frame in calib_frames]
+            return calib_frames
+
+        # engines are built for a fixed input shape, keep one per resolution and batch size
+        engine_name = f'{model_name}_{input_width}x{input_height}' + (f'_b{batch}' if batch > 1 else '')
+        engine_path = os.path.join(os.path.dirname(model_path), f'{engine_name}_{args.trt}.engine')
+        model = TrtRunner(model, input_shape, engine_path, precision=args.trt, load_calib_frames=load_calib_frames)
+    else:
+        # run the whole forward in default_dtype instead of casting weights under autocast every frame,
+        # with NHWC conv weights so cuDNN can pick its channels last tensor core kernels
+        model = model.to(dtype=default_dtype, memory_format=torch.channels_last)
+
+        # frames are stored channels last, warm up with the same layout
+        dummy_input = torch.randn(input_shape[:2] + input_shape[3:] + input_shape[2:3], device=default_device, dtype=default_dtype).permute(0, 1, 4, 2, 3)
+
+        if args.compile:
+            # the input shape never changes, so reduce-overhead can record the whole forward as one CUDA graph
+            model = torch.compile(model, mode='reduce-overhead', dynamic=False)
+        elif args.jit:
+            # trace at the fixed input shape so the padding and shape arithmetic becomes constant, then freeze the weights into the graph
+            with torch.no_grad():
+                model = torch.jit.trace(model, dummy_input)
+                model = torch.jit.optimize_for_inference(torch.jit.freeze(model))
+        elif args.tile:
+            model = util.TiledForward(model, input_shape, args.tile, scale=scale, dtype=default_dtype, device=default_device)
+
+        # warmup, compiled models need a few runs before the CUDA graph is recorded.
+        # run it in inference mode like the frame loop, so torch.compile doesn't recompile for a different grad mode
+        with torch.inference_mode():
+            for _ in range(3 if args.compile else 1):
+                if args.compile:
+                    torch.compiler.cudagraph_mark_step_begin()
+                _ = model(dummy_input)
+        del dummy_input
+
+    to_tensor4 = util.uinttensor2tensor4
+    to_uint = util.tensor2uinttensor
+    if args.compile:
+        # fuse the per-frame layout and type conversions into single kernels
+        to_tensor4 = torch.compile(to_tensor4, dynamic=False)
+        to_uint = torch.compile(to_uint, dynamic=False)
+
+    # downloads run on their own stream so they overlap with inference, uploads are run by the FrameUploader
+    copy_out_stream = torch.cuda.Stream()
+
+    # the input frames are kept in a ring buffer of the last ring_size frames, frame i is stored in slot i % ring_size.
+    # the windows centered on frames idx .. idx + batch - 1 need frames idx - clip_size // 2 .. idx + batch - 1 + clip_size // 2.
+    # with a batch of one, every frame is written to both slot and slot + ring_size, so the window is always a slice
+    # of the ring that can be passed to the model without copying. batches are gathered from the first ring_size slots,
+    # so they don't need the mirrored half. frames are stored channels last (HxWxC)
+    ring_size = clip_size + batch - 1
+    ring_slots = 2 * ring_size if batch == 1 else ring_size
+    ring_hwc = torch.empty((ring_slots,) + input_shape[3:] + input_shape[2:3], device=default_device, dtype=default_dtype)
+    ring_buf = ring_hwc.permute(0, 3, 1, 2)
+
+    def window_idx(center, last_frame=None):
+        # ring slots of the batch of windows starting at center, reflect padded at the first frame and at last_frame.
+        # a partial batch at the end of the input repeats its last window to keep the input shape fixed
+        slots = []
+        for t in range(center, center + batch):
+            if last_frame is not None:
+                t = min(t, last_frame)
+            for i in range(t - clip_size // 2, t + clip_size // 2 + 1):
+                i = abs(i)
+                if last_frame is not None and i > last_frame:
+                    i = 2 * last_frame - i
+                slots += [i % ring_size]
+        return torch.tensor(slots, device=default_device)
+
+    # precomputed gathers, indexed by the slot of the oldest frame away from the ends, by the first center at the start,
+    # and by the slot of the last frame and the number of frames left at the end
+    steady_idx = torch.stack([window_idx(clip_size // 2 + oldest) for oldest in range(ring_size)])
+    begin_idx = torch.stack([window_idx(center) for center in range(clip_size // 2)])
+    # end gathers are built for a last frame in the same slot that is far enough in to not also reflect at the start
+    end_idx = torch.stack([
+        torch.stack([window_idx(2 * ring_size + last - remaining + 1, 2 * ring_size + last) for remaining in range(1, batch + clip_size // 2)])
+        for last in range(ring_size)
+    ])
+    frames_read = 0
     image_names = []
-    total_time = 0
+    frame_timer = FrameTimer(batch=batch)
+    save_to_dir = os.path.isdir(E_path)
     end_of_video = False
+    idx = 0
+    last_progress = 0
+    last_frame_time = None
+    progress_interval = 8
+    frame_uploader = None
     video_encoder = None
+
+    def print_progress(frame_time):
+        # frame_time is None until the frame timer has measured its first interval
+        if args.gui_mode:
+            # Format optimized for GUI parsing - now includes FPS
+            fps = '' if frame_time is None else f'|FPS:{1000/frame_time:.2f}'
+            print(f'PROGRESS:{idx}/{img_count}{fps}', flush=True)
+        elif frame_time is None:
+            print(f'{idx}/{img_count}', end='\r')
+        else:
+            # Regular console output
+            time_remaining = (frame_timer.average() * (img_count - idx))/1000
+            print(f'{idx}/{img_count}   fps: {1000/frame_time:.2f}  frame time: {frame_time:.2f}ms   time remaining: {math.trunc(time_remaining/3600)}h{math.trunc((time_remaining/60)%60)}m{math.trunc(time_remaining%60)}s ', end='\r')
+
     try:
         if args.video:
             if args.fps is None and video_input:
@@ -193,8 +437,8 @@ def main():
             }
             video_encoder = VideoEncoder(
                 E_path,
-                int(output_res.split(':')[0]),
-                int(output_res.split(':')[1]),
+                output_width,
+                output_height,
                 fps=fps,
                 codec=args.video,
                 options=codec_options,
@@ -202,139 +446,157 @@ def main():
             )
             video_encoder.start()
 
-        idx = 0
-        while True:
-            start = torch.cuda.Event(enable_timing=True)
-            end = torch.cuda.Event(enable_timing=True)
-            start.record()
-
-            # ------------------------------------
-            # (1) img_L
-            # ------------------------------------
-            if video_input:
-                img_L = video_decoder.get_frame()
-            elif len(L_paths) == 0:
-                img_L = None
-            else:
+        if video_input:
+            read_frame = video_decoder.get_frame
+        else:
+            def read_frame():
+                if len(L_paths) == 0:
+                    return None
                 img_L = L_paths.pop(0)
                 img_name, ext = os.path.splitext(os.path.basename(img_L))
-                img_L = util.imread_uint(img_L, n_channels=n_channels)
-                image_names += [img_name]
-                
-            if img_L is None and not end_of_video:
-                img_count = idx + clip_size // 2
-                end_of_video = True
-                # reflect pad the end of the window
-                input_window += input_window[clip_size//2-1:-1][::-1]
-            elif not end_of_video:
-                if args.presize:
-                    img_L = cv2.resize(img_L, (int(output_res.split(':')[0])//scale, int(output_res.split(':')[1])//scale), interpolation=cv2.INTER_CUBIC)
-            
-                img_L_t = util.uint2tensor4(img_L)
-                img_L_t = img_L_t.to(default_device, dtype=default_dtype)
-
-                input_window += [img_L_t]
-
-            if len(input_window) < clip_size and end_of_video:
-                # no more frames to process
-                break
-            elif len(input_window) < clip_size // 2 + 1:
-                # wait for more frames
-                continue
-            elif len(input_window) == clip_size // 2 + 1:
-                # reflect pad the beginning of the window
-                input_window = input_window[1:][::-1] + input_window
-
-            # ------------------------------------
-            # (2) img_E
-            # ------------------------------------
+                image_names.append(img_name)
+                return util.imread_uint(img_L, n_channels=n_channels)
+
+        # decode and upload frames ahead of inference
+        frame_uploader = FrameUploader(read_frame, default_device, clip_size * 2)
+        frame_uploader.start()
+
+        # no autograd bookkeeping is needed for any of the per-frame work
+        with torch.inference_mode():
+            while True:
+                # ------------------------------------
+                # (1) img_L
+                # ------------------------------------
+                if not end_of_video:
+                    img_L, img_L_ready = frame_uploader.get_frame()
+
+                    if img_L is None:
+                        img_count = frames_read
+                        end_of_video = True
+                    else:
+                        # wait for the upload, the layout and type conversion then runs on the GPU
+                        torch.cuda.current_stream().wait_event(img_L_ready)
+                        img_L.record_stream(torch.cuda.current_stream())
+
+                        img_L_t = to_tensor4(img_L, default_dtype, max_value=255.)
+                        if args.presize:
+                            img_L_t = torch.nn.functional.interpolate(img_L_t, size=(input_height, input_width), mode='bicubic', align_corners=False).clamp_(0, 255)
+
+                        # overwrite the oldest frame, and its mirror if the ring has one
+                        ring_buf[frames_read % ring_size::ring_size].copy_(img_L_t)
+                        frames_read += 1
+
+                if end_of_video:
+                    if frames_read <= clip_size // 2 or idx >= frames_read:
+                        # no more frames to process
+                        break
+                elif frames_read < idx + batch + clip_size // 2:
+                    # wait for more frames
+                    continue
+
+                # ------------------------------------
+                # (2) img_E
+                # ------------------------------------
             
-            #rng_state = torch.get_rng_state()
-            #torch.manual_seed(13)
-            window = torch.stack(input_window[:clip_size], dim=1)
+                #rng_state = torch.get_rng_state()
+                #torch.manual_seed(13)
+                oldest = (idx - clip_size // 2) % ring_size
+                if end_of_video and idx + batch + clip_size // 2 > frames_read and idx < clip_size // 2:
+                    # the input is too short to reach the end without also padding the start
+                    slots = window_idx(idx, frames_read - 1)
+                elif end_of_video and idx + batch + clip_size // 2 > frames_read:
+                    # reflect pad the end of the input
+                    slots = end_idx[(frames_read - 1) % ring_size, frames_read - idx - 1]
+                elif idx < clip_size // 2:
+                    # reflect pad the start of the input
+                    slots = begin_idx[idx]
+                elif batch == 1:
+                    slots = None
+                else:
+                    slots = steady_idx[oldest]
+
+                if slots is None:
+                    window = ring_buf[oldest:oldest + clip_size].unsqueeze(0)
+                else:
+                    # TSCUNet folds the batch and clip dimensions together, so overlapping windows are gathered into one tensor
+                    window = ring_hwc.index_select(0, slots).view(input_shape[:2] + input_shape[3:] + input_shape[2:3]).permute(0, 1, 4, 2, 3)
+                frame_time = frame_timer.record()
             
-            with torch.cuda.amp.autocast(dtype=default_dtype):
-                img_E = model(window)
-            #img_E, _ = util.tiled_forward(model, window, overlap=256, scale=scale)
+                if args.compile:
+                    torch.compiler.cudagraph_mark_step_begin()
+                img_E_batch = model(window)
             
-            del window
-
-            # replace the current frame in the window with the reconstructed frame
-            #input_window[clip_size//2] = torch.nn.functional.interpolate(img_E, scale_factor=1/scale, mode='bicubic')
-            # remove the oldest frame from the window
-            input_window.pop(0)
-
-            img_E = util.tensor2uint(img_E, args.depth)
-            #torch.set_rng_state(rng_state)
-
-            # ------------------------------------
-            # save results
-            # ------------------------------------
-            if args.video:
-                img_E = cv2.resize(img_E, (int(output_res.split(':')[0]), int(output_res.split(':')[1])), interpolation=cv2.INTER_CUBIC)
-
-            if args.video:
-                video_encoder.add_frame(img_E)
-            elif os.path.isdir(E_path):
-                util.imsave(img_E, os.path.join(E_path, f'{image_names.pop(0)}_{suffix}.png'))
-            else:
-                util.imsave(img_E, E_path)
-
-            end.record()
-            torch.cuda.synchronize()
-
-            idx += 1
-            time_taken = start.elapsed_time(end)
-            total_time += time_taken
-            time_remaining = ((total_time / (idx)) * (img_count - (idx+1)))/1000
-
-            if args.gui_mode:
-                # Format optimized for GUI parsing - now includes FPS
-                print(f'PROGRESS:{idx}/{img_count}|FPS:{1000/time_taken:.2f}', flush=True)
-            else:
-                # Regular console output
-                print(f'{idx}/{img_count}   fps: {1000/time_taken:.2f}  frame time: {time_taken:.2f}ms   time remaining: {math.trunc(time_remaining/3600)}h{math.trunc((time_remaining/60)%60)}m{math.trunc(time_remaining%60)}s ', end='\r')
+                del window
+
+                # replace the current frame in the window with the reconstructed frame
+                #ring_buf[idx % ring_size::ring_size] = torch.nn.functional.interpolate(img_E, scale_factor=1/scale, mode='bicubic')
+                #torch.set_rng_state(rng_state)
+
+                # ------------------------------------
+                # save results
+                # ------------------------------------
+                # hand the batch to the encoder one frame at a time, dropping the repeated windows of a partial batch
+                for img_E in img_E_batch[:min(batch, frames_read - idx)].split(1):
+                    if args.video:
+                        # resize and quantize on the GPU, the encoder thread downloads the finished frame
+                        if resize_output:
+                            img_E = torch.nn.functional.interpolate(img_E.float(), size=(output_height, output_width), mode='bicubic', align_corners=False)
+                        img_E = to_uint(img_E, args.depth)
+
+                        # download into pinned memory on the copy stream, the encoder waits for the copy to finish
+                        copy_out_stream.wait_stream(torch.cuda.current_stream())
+                        with torch.cuda.stream(copy_out_stream):
+                            img_E_host = torch.empty(img_E.shape, dtype=img_E.dtype, pin_memory=True)
+                            img_E_host.copy_(img_E, non_blocking=True)
+                            img_E.record_stream(copy_out_stream)
+                            img_E_ready = torch.cuda.Event()
+                            img_E_ready.record()
+
+                        video_encoder.add_frame(img_E_host, ready=img_E_ready)
+                    elif save_to_dir:
+                        util.imsave(util.tensor2uint(img_E, args.depth), os.path.join(E_path, f'{image_names.pop(0)}_{suffix}.png'))
+                    else:
+                        util.imsave(util.tensor2uint(img_E, args.depth), E_path)
+
+                    idx += 1
+
+                # report progress every progress_interval frames and whenever a new frame time was measured
+                if frame_time is not None:
+                    last_frame_time = frame_time
+                elif idx - last_progress < progress_interval:
+                    continue
+                last_progress = idx
+                print_progress(last_frame_time)
+
+        # the frame count of videos is an estimate until the end of the input, so always report the final count
+        if idx > 0:
+            print_progress(last_frame_time)
     except KeyboardInterrupt:
         print("\nCaught KeyboardInterrupt, ending gracefully")
     except Exception as e:
         print("\n" + str(e))
     finally:
         # Clean up code that should run regardless of how the script ends
-        if video_encoder is not None:
-            try:
-                video_encoder.stop()
-                # Add timeout to join to prevent hanging
-                video_encoder.join(timeout=5)
-                if idx > 0:
-                    print(f"Saved video to {E_path}")
-            except Exception as e:
-                print(f"Error while closing video encoder: {e}")
-            finally:
-                # Force close the output container if still open
-                if hasattr(video_encoder, 'output_container') and video_encoder.output_container:
-                    try:
-                        video_encoder.output_container.close()
-                    except:
-                        pass
-
         if video_input:
-            try:
-                video_encoder.stop()
-                # Add timeout to join to prevent hanging
-                video_encoder.join(timeout=5)
-                if idx > 0:
-                    print(f"Saved video to {E_path}")
-                    # Print hyperlink to output directory instead of file
-                    output_dir = os.path.dirname(os.path.abspath(E_path))
-                    print(f"\033]8;;file://{output_dir}\033\\Click to open output directory\033]8;;\033\\")
-            except Exception as e:
-                print(f"Error while closing video encoder: {e}")
+            video_decoder.stop()
+        if frame_uploader is not None:
+            frame_uploader.stop()
 
-        if idx > 0:
-            print(f'Processed {idx} images in {timedelta(milliseconds=total_time)}, average {total_time / idx:.2f}ms per image              ')
+        if video_encoder is not None:
+            # the encoder writes the frames that are still queued before closing the output file
+            video_encoder.stop()
+            video_encoder.join()
+            if video_encoder.error is not None:
+                print(f"Error while encoding video: {video_encoder.error}")
+            elif idx > 0:
+                print(f"Saved video to {E_path}")
+                # Print hyperlink to output directory instead of file
+                output_dir = os.path.dirname(os.path.abspath(E_path))
+                print(f"\033]8;;file://{output_dir}\033\\Click to open output directory\033]8;;\033\\")
 
-        # Force exit to ensure all threads are terminated
-        os._exit(0)
+        if idx > 0:
+            frame_timer.finish()
+            print(f'Processed {idx} images in {timedelta(milliseconds=frame_timer.average() * idx)}, average {frame_timer.average():.2f}ms per image              ')
 
 if __name__ == '__main__':
 
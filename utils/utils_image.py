@@ -301,6 +301,33 @@ def tensor2uint(img, depth=8):
         return np.uint16((img*(2**depth-1)).round())
 
 
+# --------------------------------------------
+# tensor(uint) (HxWxC) <--->  tensor, converted on the tensor's device
+# --------------------------------------------
+
+
+# convert HxWxC uint tensor to 4-dimensional float tensor in the range [0, max_value]. int16 tensors are read as the
+# bit pattern of uint16 like tensor2uinttensor returns, since older torch versions can't upload or convert uint16
+def uinttensor2tensor4(img, dtype=torch.float32, max_value=1.):
+    bit_depth = img.element_size() * 8
+    if img.dtype == torch.int16:
+        img = img.to(torch.int32) & 0xFFFF
+    img = img.permute(2, 0, 1).unsqueeze(0)
+    if max_value != 2**bit_depth-1:
+        # scale in float32, 16-bit values don't fit the mantissa of half precision types
+        img = img.float().mul_(max_value/(2**bit_depth-1))
+    return img.to(dtype)
+
+
+# convert 3/4-dimensional float tensor to HxWxC uint tensor, 16-bit values are returned as the bit pattern
+# of uint16 in an int16 tensor, since CUDA has no uint16 kernels. view the numpy array as np.uint16
+def tensor2uinttensor(img, depth=8):
+    img = img.squeeze(0).float().clamp(0, 1).mul_(2**depth-1).round_().permute(1, 2, 0)
+    if depth == 8:
+        return img.to(torch.uint8).contiguous()
+    return img.to(torch.int32).to(torch.int16).contiguous()
+
+
 # --------------------------------------------
 # numpy(single) (HxWxC) <--->  tensor
 # --------------------------------------------
@@ -1096,6 +1123,91 @@ def join_tiles(tiles: tuple[torch.Tensor, ...], overlap: int) -> torch.Tensor:
     return joined_tile
 
 
+def tile_ranges(length: int, tile_size: int, overlap: int) -> list[tuple[int, int]]:
+    """
+    Split a dimension of the given length into tiles of tile_size that overlap by at least overlap.
+    The last tile is aligned to the end so every tile has the same size.
+    """
+    if length <= tile_size:
+        return [(0, length)]
+
+    starts = list(range(0, length - tile_size, tile_size - overlap)) + [length - tile_size]
+    return [(start, start + tile_size) for start in starts]
+
+
+def blend_ramp(start: int, end: int, length: int, overlap: int) -> torch.Tensor:
+    """
+    1-D blend weights of a tile spanning [start, end) of a dimension of the given length.
+    The weights fall off with a raised cosine over the overlap on each side that has a neighbouring tile.
+    """
+    weights = torch.ones(end - start)
+    ramp = 0.5 - 0.5 * torch.cos(math.pi * (torch.arange(overlap) + 0.5) / overlap)
+    if start > 0:
+        weights[:overlap] = ramp
+    if end < length:
+        weights[-overlap:] = ramp.flip(0)
+    return weights
+
+
+class TiledForward:
+    """
+    Run a model over overlapping spatial tiles of a fixed-size input and blend the results into a persistent output tensor.
+    Tiles alternate between CUDA streams so they can share the GPU, while blending stays on the calling stream.
+    Expects input PyTorch Tensor's shape to end in CHW order, the returned tensor is overwritten by the next call.
+    """
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        input_shape: tuple[int, ...],
+        tile_size: int,
+        overlap: int = 32,
+        scale: int = 4,
+        dtype: torch.dtype = torch.float32,
+        device: torch.device = torch.device('cuda'),
+        num_streams: int = 2,
+    ):
+        if tile_size <= overlap:
+            raise ValueError(f'tile size {tile_size} must be larger than the tile overlap of {overlap}')
+
+        c, h, w = input_shape[-3:]
+        self.model = model
+        self.scale = scale
+        self.tiles = [(y0, y1, x0, x1) for y0, y1 in tile_ranges(h, tile_size, overlap) for x0, x1 in tile_ranges(w, tile_size, overlap)]
+        self.streams = [torch.cuda.Stream(device) for _ in range(num_streams)]
+        self.out = torch.empty((input_shape[0], c, h * scale, w * scale), dtype=dtype, device=device)
+
+        # normalize the blend weights so the weights of all tiles sum to one at every output pixel
+        weights = [
+            blend_ramp(y0 * scale, y1 * scale, h * scale, overlap * scale)[:, None] * blend_ramp(x0 * scale, x1 * scale, w * scale, overlap * scale)[None, :]
+            for y0, y1, x0, x1 in self.tiles
+        ]
+        total = torch.zeros((h * scale, w * scale))
+        for (y0, y1, x0, x1), weight in zip(self.tiles, weights):
+            total[y0 * scale:y1 * scale, x0 * scale:x1 * scale] += weight
+        self.weights = [
+            (weight / total[y0 * scale:y1 * scale, x0 * scale:x1 * scale]).to(device, dtype=dtype)
+            for (y0, y1, x0, x1), weight in zip(self.tiles, weights)
+        ]
+
+    def __call__(self, t: torch.Tensor) -> torch.Tensor:
+        current_stream = torch.cuda.current_stream()
+        ready = current_stream.record_event()
+        self.out.zero_()
+
+        s = self.scale
+        for i, (y0, y1, x0, x1) in enumerate(self.tiles):
+            stream = self.streams[i % len(self.streams)]
+            stream.wait_event(ready)
+            with torch.cuda.stream(stream):
+                tile = self.model(t[..., y0:y1, x0:x1])
+
+            current_stream.wait_stream(stream)
+            tile.record_stream(current_stream)
+            self.out[..., y0 * s:y1 * s, x0 * s:x1 * s].addcmul_(tile, self.weights[i])
+
+        return self.out
+
+
 # https://github.com/chaiNNer-org/chaiNNer/blob/main/backend/src/nodes/nodes/image_filter/avg_color_fix.py
 # https://github.com/chaiNNer-org/chaiNNer
 
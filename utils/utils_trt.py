@@ -0,0 +1,159 @@
+import os
+import numpy as np
+import torch
+import tensorrt as trt
+
+from convert_to_onnx import TSCUNetExportWrapper
+from utils import utils_image as util
+
+TRT_LOGGER = trt.Logger(trt.Logger.WARNING)
+
+TRT_DTYPES = {
+    trt.float32: torch.float32,
+    trt.float16: torch.float16,
+}
+
+
+class Int8EntropyCalibrator(trt.IInt8EntropyCalibrator2):
+    """
+    Feeds batches of consecutive clips built from decoded 8 or 16-bit HxWx3 frames to the INT8 calibrator.
+    Frames are scaled to [0, 255] like test_vsr's input, which has the 1/255 normalization folded into the first conv.
+    """
+    def __init__(self, frames, clip_size, cache_file, batch_size=1):
+        trt.IInt8EntropyCalibrator2.__init__(self)
+
+        self.frames = frames
+        self.clip_size = clip_size
+        self.cache_file = cache_file
+        self.index = 0
+
+        h, w = frames[0].shape[:2]
+        self.batch = torch.empty((batch_size, clip_size * 3, h, w), dtype=torch.float32, device='cuda')
+
+    def get_batch_size(self):
+        # the network has an explicit batch dimension, get_batch fills all of it
+        return 1
+
+    def get_batch(self, names):
+        # the clips of a batch overlap like the windows test_vsr runs the engine with
+        batch_size = self.batch.shape[0]
+        if self.index + self.clip_size + batch_size - 1 > len(self.frames):
+            return None
+
+        clips = torch.cat([
+            # 16-bit frames are uploaded as their int16 bit pattern, as test_vsr does
+            util.uinttensor2tensor4(torch.from_numpy(frame.view(np.int16) if frame.dtype == np.uint16 else frame).to(self.batch.device), max_value=255.)
+            for frame in self.frames[self.index:self.index + self.clip_size + batch_size - 1]
+        ])
+        for b in range(batch_size):
+            self.batch[b].copy_(clips[b:b + self.clip_size].reshape(self.batch.shape[1:]))
+        self.index += batch_size
+
+        return [int(self.batch.data_ptr())]
+
+    def read_calibration_cache(self):
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file, 'rb') as f:
+                return f.read()
+        return None
+
+    def write_calibration_cache(self, cache):
+        with open(self.cache_file, 'wb') as f:
+            f.write(cache)
+
+
+def build_engine(model, input_shape, engine_path, precision='fp16', load_calib_frames=None):
+    """
+    Export TSCUNet to a static-shape ONNX graph and build a serialized TensorRT engine from it.
+    input_shape is the (batch, clip_size, channels, height, width) shape the engine will be run with.
+    load_calib_frames returns the HxWx3 uint8 or uint16 frames INT8 engines are calibrated on.
+    """
+    b, t, c, h, w = input_shape
+    onnx_path = os.path.splitext(engine_path)[0] + '.onnx'
+
+    wrapper = TSCUNetExportWrapper(model).eval()
+    # inference only uses the image, leave the sigma branch of sigma models out of the graph
+    wrapper.sigma = False
+    dummy_input = torch.randn((b, t * c, h, w), device=next(model.parameters()).device)
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            dummy_input,
+            onnx_path,
+            opset_version=17,
+            input_names=['input'],
+            output_names=['output'],
+            dynamic_axes=None,
+        )
+
+    builder = trt.Builder(TRT_LOGGER)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, TRT_LOGGER)
+    if not parser.parse_from_file(onnx_path):
+        errors = '\n'.join(str(parser.get_error(i)) for i in range(parser.num_errors))
+        raise RuntimeError(f'Failed to parse {onnx_path}:\n{errors}')
+
+    config = builder.create_builder_config()
+    config.builder_optimization_level = 5
+    config.set_flag(trt.BuilderFlag.FP16)
+    if precision == 'int8':
+        calib_frames = load_calib_frames() if load_calib_frames else None
+        if not calib_frames:
+            raise ValueError('INT8 engines require calibration frames')
+        config.set_flag(trt.BuilderFlag.INT8)
+        config.int8_calibrator = Int8EntropyCalibrator(calib_frames, t, os.path.splitext(engine_path)[0] + '.cache', batch_size=b)
+
+    serialized_engine = builder.build_serialized_network(network, config)
+    if serialized_engine is None:
+        raise RuntimeError('Failed to build TensorRT engine')
+
+    with open(engine_path, 'wb') as f:
+        f.write(serialized_engine)
+
+
+class TrtRunner:
+    """
+    Runs a TensorRT TSCUNet engine on CUDA tensors through a captured CUDA graph.
+    The returned tensor is a persistent output buffer that is overwritten by the next call.
+    The engine is only built, and calibration frames only loaded, when engine_path doesn't exist yet.
+    """
+    def __init__(self, model, input_shape, engine_path, precision='fp16', load_calib_frames=None):
+        if not os.path.exists(engine_path):
+            print(f'Building TensorRT engine {engine_path}, this can take a while...')
+            build_engine(model, input_shape, engine_path, precision, load_calib_frames)
+
+        self.runtime = trt.Runtime(TRT_LOGGER)
+        with open(engine_path, 'rb') as f:
+            self.engine = self.runtime.deserialize_cuda_engine(f.read())
+        self.context = self.engine.create_execution_context()
+
+        if self.engine.num_io_tensors != 2:
+            raise RuntimeError(f'{engine_path} was built with the sigma output, delete it so it can be rebuilt')
+
+        # Allocate the engine's input and output buffers once so the CUDA graph can bind them permanently
+        for i in range(self.engine.num_io_tensors):
+            name = self.engine.get_tensor_name(i)
+            shape = tuple(self.engine.get_tensor_shape(name))
+            dtype = TRT_DTYPES[self.engine.get_tensor_dtype(name)]
+            tensor = torch.empty(shape, dtype=dtype, device='cuda')
+            self.context.set_tensor_address(name, tensor.data_ptr())
+            if self.engine.get_tensor_mode(name) == trt.TensorIOMode.INPUT:
+                self.input = tensor
+            else:
+                self.output = tensor
+
+        # TensorRT allocates lazily on the first enqueue, so run once before capturing
+        stream = torch.cuda.Stream()
+        with torch.cuda.stream(stream):
+            self.input.zero_()
+            self.context.execute_async_v3(stream.cuda_stream)
+        stream.synchronize()
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.context.execute_async_v3(torch.cuda.current_stream().cuda_stream)
+
+    def __call__(self, x):
+        self.input.view(x.shape).copy_(x)
+        self.graph.replay()
+        return self.output
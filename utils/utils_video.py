@@ -1,13 +1,21 @@
 import gc
 import av
+import numpy as np
 import threading
 import queue
 
 from fractions import Fraction
 
+try:
+    import torch
+    import PyNvVideoCodec as nvc
+except ImportError:
+    nvc = None
+
 class VideoDecoder(threading.Thread):
     def __init__(self, input_path, options={}):
-        super().__init__()
+        # Daemon threads don't keep the interpreter alive if decoding is stopped while blocked on a full queue
+        super().__init__(daemon=True)
 
         # Open the input file and get the video stream
         self.input_container = av.open(input_path, options=options)
@@ -28,6 +36,8 @@ class VideoDecoder(threading.Thread):
         while self.running:
             try:
                 for frame in self.input_container.decode(video=0):
+                    if not self.running:
+                        break
                     self.frame_queue.put(frame.to_ndarray(format='rgb24'), block=True)
             except av.error.EOFError:
                 self.running = False
@@ -48,9 +58,60 @@ class VideoDecoder(threading.Thread):
     def __len__(self):
         return self.frame_count
 
+def nv12_to_rgb(frame, height):
+    """Convert an NV12 CUDA tensor of shape (height*3/2, width) to uint8 RGB (height, width, 3) using limited range BT.601, matching PyAV's rgb24 conversion"""
+    y = (frame[:height].float() - 16.) * 1.164
+    uv = frame[height:].view(height // 2, -1, 2).float() - 128.
+    uv = uv.repeat_interleave(2, dim=0).repeat_interleave(2, dim=1)
+    u, v = uv[..., 0], uv[..., 1]
+
+    rgb = torch.stack((
+        y + 1.596 * v,
+        y - 0.392 * u - 0.813 * v,
+        y + 2.017 * u,
+    ), dim=-1)
+    return rgb.clamp_(0, 255).round_().to(torch.uint8)
+
+class NvVideoDecoder(VideoDecoder):
+    """
+    Decodes 8-bit 4:2:0 video with NVDEC, yielding uint8 HxWx3 RGB frames as CUDA tensors.
+    get_frame returns each frame with the CUDA event to wait on before using it.
+    """
+    def __init__(self, input_path, options={}, gpu_id=0):
+        if nvc is None:
+            raise ImportError('PyNvVideoCodec is required for NVDEC decoding')
+
+        # The PyAV container is only kept for stream metadata such as the frame count
+        super().__init__(input_path, options=options)
+
+        # NVDEC returns 16-bit planes for high bit depth video, which nv12_to_rgb can't convert
+        pix_fmt = self.input_stream.format.name
+        if pix_fmt not in ('yuv420p', 'nv12'):
+            self.input_container.close()
+            raise ValueError(f'NVDEC decoding requires 8-bit 4:2:0 video, got {pix_fmt}')
+
+        self.demuxer = nvc.CreateDemuxer(filename=input_path)
+        self.decoder = nvc.CreateDecoder(gpuid=gpu_id, codec=self.demuxer.GetNvCodecId(), cudacontext=0, cudastream=0, usedevicememory=True)
+        self.height = self.input_stream.height
+
+    def run(self):
+        self.input_container.close()
+
+        for packet in self.demuxer:
+            for frame in self.decoder.Decode(packet):
+                if not self.running:
+                    return
+                # the conversion runs on this thread's stream, record when it's done for the consumer to wait on
+                rgb = nv12_to_rgb(torch.from_dlpack(frame), self.height)
+                ready = torch.cuda.Event()
+                ready.record()
+                self.frame_queue.put((rgb, ready), block=True)
+
+        self.running = False
+
 class VideoEncoder(threading.Thread):
     def __init__(self, output_path, width, height, fps=Fraction(24000, 1001), codec='libx264', pix_fmt='yuv420p', options={}, input_depth=8):
-        super().__init__()
+        super().__init__(daemon=True)
 
         # Create a video container and stream with the specified codec and parameters
         self.output_container = av.open(output_path, mode='w')
@@ -64,35 +125,63 @@ class VideoEncoder(threading.Thread):
         # Create a queue to hold the frames that will be encoded
         self.frame_queue = queue.Queue(3)
 
-        # Set a flag to indicate whether the thread should continue running
-        self.running = True
+        # Set to the exception that ended the encoder thread, if any
+        self.error = None
 
     def run(self):
-        # Keep encoding frames until the running flag is set to False
-        while self.running:
-            # Try to get a frame from the queue
-            try:
-                frame = self.frame_queue.get(block=True, timeout=1)
-            except queue.Empty:
-                continue
-
-            # Encode the frame
-            frame = av.VideoFrame.from_ndarray(frame, format="rgb48le" if self.input_depth == 16 else "rgb24")
-            for packet in self.stream.encode(frame):
-                self.output_container.mux(packet)
+        try:
+            # Keep encoding frames until stop() queues the end of the stream, so every frame added before it is written
+            while True:
+                frame, ready = self.frame_queue.get(block=True)
+                if frame is None:
+                    break
+
+                # Wait for an asynchronous copy of the frame to finish
+                if ready is not None:
+                    ready.synchronize()
+
+                # Frames can be handed over as CUDA tensors, download them here so the caller doesn't wait on the copy
+                if not isinstance(frame, np.ndarray):
+                    frame = frame.cpu().numpy()
+                if self.input_depth == 16 and frame.dtype == np.int16:
+                    # 16-bit GPU frames hold the uint16 bit pattern in int16
+                    frame = frame.view(np.uint16)
+                elif self.input_depth == 16:
+                    frame = frame.astype(np.uint16, copy=False)
+
+                # Encode the frame
+                frame = av.VideoFrame.from_ndarray(frame, format="rgb48le" if self.input_depth == 16 else "rgb24")
+                for packet in self.stream.encode(frame):
+                    self.output_container.mux(packet)
             
-            del frame
-            gc.collect()
+                del frame
+                gc.collect()
 
-        # Flush the encoder and close the output file when the thread is finished
-        for packet in self.stream.encode():
-            self.output_container.mux(packet)
-        self.output_container.close()
+            # Flush the encoder and close the output file when the thread is finished
+            for packet in self.stream.encode():
+                self.output_container.mux(packet)
+            self.output_container.close()
+        except Exception as e:
+            # Keep the error for add_frame to raise, so callers don't block on a queue nobody reads anymore
+            self.error = e
 
-    def add_frame(self, frame):
-        # Add a frame to the queue
-        self.frame_queue.put(frame, block=True)
+    def add_frame(self, frame, ready=None):
+        # Add a HxWx3 frame to the queue, either as a numpy array or a tensor of integer pixel values.
+        # ready is an optional event that is set once the frame's contents are available
+        self.put((frame, ready))
 
     def stop(self):
-        # Set the running flag to False to stop the thread
-        self.running = False
\ No newline at end of file
+        # Finish encoding the queued frames, then flush the encoder and close the output file. Does nothing if the encoder failed
+        if self.is_alive():
+            self.put((None, None))
+
+    def put(self, item):
+        # Wait for space in the queue while checking that the encoder thread is still running
+        while True:
+            if not self.is_alive():
+                raise RuntimeError(f'Video encoder stopped: {self.error}') from self.error
+            try:
+                self.frame_queue.put(item, block=True, timeout=1)
+                return
+            except queue.Full:
+                continue